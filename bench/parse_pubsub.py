@@ -0,0 +1,97 @@
+#! /usr/bin/env python
+
+# Copyright 2012 James Tait - All Rights Reserved
+
+"""Micro-benchmark of classifying PubSub iqs.
+
+Compares parse_pubsub with walking the stanza through getTag/getTagData, as
+the handlers did before the request parser.  Both pull out the same fields.
+Run from the top of the tree with:
+
+    PYTHONPATH=src python bench/parse_pubsub.py [iterations]
+"""
+
+import sys
+import timeit
+import xmpp
+
+from buddycloud.channel_server.request import (
+    NS_PUBSUB_OWNER,
+    NS_RSM,
+    parse_pubsub,
+)
+
+
+PUBLISH = (
+    '<iq xmlns="jabber:client" type="set" to="channels.example.org" '
+    'from="juliet@example.org/balcony" id="1">'
+    '<pubsub xmlns="http://jabber.org/protocol/pubsub">'
+    '<publish node="/user/juliet@example.org/posts"><item>'
+    '<entry xmlns="http://www.w3.org/2005/Atom">'
+    '<author><name>juliet@example.org</name></author>'
+    '<content>Wherefore art thou?</content>'
+    '<updated>2012-01-01T00:00:00Z</updated>'
+    '</entry></item></publish></pubsub></iq>')
+
+ITEMS = (
+    '<iq xmlns="jabber:client" type="get" to="channels.example.org" '
+    'from="romeo@example.org/orchard" id="2">'
+    '<pubsub xmlns="http://jabber.org/protocol/pubsub">'
+    '<items node="/user/juliet@example.org/posts"/>'
+    '<set xmlns="http://jabber.org/protocol/rsm">'
+    '<max>10</max><after>2012-01-01T00:00:00|1</after></set>'
+    '</pubsub></iq>')
+
+
+def walk_publish(event):
+    """Pull the publish fields out with getTag, as the old handler did."""
+    tag = event.getTag('pubsub')
+    if tag and tag.getNamespace() == xmpp.protocol.NS_PUBSUB:
+        publish = tag.getTag('publish')
+        entry = publish.getTag('item').getTag('entry')
+        return (publish.getAttr('node'),
+            entry.getTag('author').getTagData('name'),
+            entry.getTagData('updated'))
+
+
+def parse_publish(event):
+    """Pull the publish fields out with parse_pubsub."""
+    request = parse_pubsub(event)
+    return (request.node,
+        request.entry_fields['author'].getTagData('name'),
+        request.entry_fields['updated'].getData())
+
+
+def walk_items(event):
+    """Pull the items fields out with getTag, as the old handler did."""
+    tag = event.getTag('pubsub')
+    if tag and (tag.getNamespace() == xmpp.protocol.NS_PUBSUB or
+            tag.getNamespace() == NS_PUBSUB_OWNER):
+        child = tag.getChildren()[0]
+        rsm = tag.getTag('set', namespace=NS_RSM)
+        return (child.getName(), child.getAttr('node'),
+            rsm.getTagData('max'), rsm.getTagData('after'))
+
+
+def parse_items(event):
+    """Pull the items fields out with parse_pubsub."""
+    request = parse_pubsub(event)
+    return request.op, request.node, request.rsm_max, request.rsm_after
+
+
+def main(iterations):
+    """Time each way of classifying each stanza."""
+    for name, xml, walk, parse in (
+            ('publish', PUBLISH, walk_publish, parse_publish),
+            ('items', ITEMS, walk_items, parse_items)):
+        event = xmpp.Iq(node=xmpp.simplexml.XML2Node(xml))
+        assert walk(event) == parse(event)
+        for label, func in (('getTag walk', walk), ('parse_pubsub', parse)):
+            best = min(timeit.repeat(lambda: func(event),
+                number=iterations, repeat=7))
+            print '%-8s %-13s %6.2f us/stanza' % (
+                name, label, best / iterations * 1e6)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
@@ -0,0 +1,155 @@
+# Copyright 2012 James Tait - All Rights Reserved
+
+"""Access control for buddycloud channel server."""
+
+import math
+
+from collections import OrderedDict
+
+from buddycloud.channel_server.storage import DEFAULT_CONFIG
+
+
+CAN_RETRIEVE = 1
+CAN_PUBLISH = 2
+
+PUBLISHER_AFFILIATIONS = frozenset([u'owner', u'moderator', u'publisher'])
+MEMBER_AFFILIATIONS = PUBLISHER_AFFILIATIONS | frozenset([u'member'])
+
+# A node's cached per-JID decisions are dropped wholesale beyond this many.
+MAX_CACHED_DECISIONS = 10000
+
+# The policies of the least recently used nodes are dropped beyond this many.
+MAX_CACHED_POLICIES = 1000
+
+# Hard limits on notification coalescing, whatever the node asks for.
+MAX_COALESCE_WINDOW = 60
+MAX_COALESCE_ITEMS = 50
+DEFAULT_COALESCE_ITEMS = 20
+
+
+def coalesce_settings(config):
+    """Get the coalescing window and batch size from a node's configuration,
+    clamped to the server limits.
+
+    A window that is not a finite, non-negative number of seconds turns
+    coalescing off; a batch size that is not a number gets the default.
+    """
+    try:
+        window = float(config.get(u'coalesceWindow', 0))
+    except (TypeError, ValueError):
+        window = 0
+    if math.isnan(window) or math.isinf(window) or window < 0:
+        window = 0
+    try:
+        max_items = int(config.get(u'coalesceMaxItems',
+            DEFAULT_COALESCE_ITEMS))
+    except (TypeError, ValueError):
+        max_items = DEFAULT_COALESCE_ITEMS
+    return (min(window, MAX_COALESCE_WINDOW),
+        max(1, min(max_items, MAX_COALESCE_ITEMS)))
+
+
+class NodePolicy(object):
+    """The access and notification configuration of a node, along with the
+    affiliations and subscriptions of its users."""
+
+    def __init__(self, channel):
+        config = dict(DEFAULT_CONFIG)
+        config.update((c.key, c.value) for c in channel.config)
+        self.access_model = config[u'accessModel']
+        self.publish_model = config[u'publishModel']
+        self.default_affiliation = config[u'defaultAffiliation']
+        self.coalesce_window, self.coalesce_max_items = coalesce_settings(
+            config)
+        self.affiliations = dict(
+            (a.user, a.affiliation) for a in channel.affiliations)
+        self.subscriptions = dict(
+            (s.user, s.subscription) for s in channel.subscriptions)
+        self.decisions = {}
+
+    def permissions(self, jid):
+        """Get what the given JID may do on the node, as a combination of
+        CAN_RETRIEVE and CAN_PUBLISH."""
+        permissions = self.decisions.get(jid)
+        if permissions is None:
+            if len(self.decisions) >= MAX_CACHED_DECISIONS:
+                self.decisions.clear()
+            permissions = self.decisions[jid] = self._decide(jid)
+        return permissions
+
+    def subscribers(self):
+        """Get the JIDs to notify of new items: those that are subscribed
+        and may retrieve items."""
+        return [jid for jid, subscription in self.subscriptions.items()
+            if subscription == u'subscribed' and
+                self.permissions(jid) & CAN_RETRIEVE]
+
+    def _decide(self, jid):
+        """Work out the permissions of the given JID."""
+        subscribed = self.subscriptions.get(jid) == u'subscribed'
+        affiliation = self.affiliations.get(jid)
+        if affiliation is None and subscribed:
+            affiliation = self.default_affiliation
+        if affiliation == u'outcast':
+            return 0
+        permissions = 0
+        if (self.access_model == u'open' or subscribed or
+                affiliation in MEMBER_AFFILIATIONS):
+            permissions |= CAN_RETRIEVE
+        if (self.publish_model == u'open' or
+                (self.publish_model == u'subscribers' and subscribed) or
+                affiliation in PUBLISHER_AFFILIATIONS):
+            permissions |= CAN_PUBLISH
+        return permissions
+
+
+class AccessControl(object):
+    """Decides who may retrieve from and publish to nodes.
+
+    Each node's policy is loaded from storage once and each JID's decision
+    on it is worked out once, so that checking a request is a dictionary
+    lookup.  The storage back-end tells us when a node's configuration,
+    affiliations or subscriptions are written, and its policy is dropped.
+    At most MAX_CACHED_POLICIES policies are kept, least recently used
+    first out.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.policies = OrderedDict()
+        storage.add_change_listener(self.invalidate)
+
+    def policy(self, node):
+        """Get the cached policy of a node, or None if there is no such
+        node."""
+        policy = self.policies.pop(node, None)
+        if policy is None:
+            channel = self.storage.get_node(node)
+            if channel is None:
+                return None
+            policy = NodePolicy(channel)
+            if len(self.policies) >= MAX_CACHED_POLICIES:
+                self.policies.popitem(last=False)
+        self.policies[node] = policy
+        return policy
+
+    def permissions(self, node, jid):
+        """Get the permissions of the JID on the node."""
+        policy = self.policy(node)
+        return policy.permissions(jid) if policy is not None else 0
+
+    def can_retrieve(self, node, jid):
+        """Check whether the JID may retrieve items from the node."""
+        return bool(self.permissions(node, jid) & CAN_RETRIEVE)
+
+    def can_publish(self, node, jid):
+        """Check whether the JID may publish items to the node."""
+        return bool(self.permissions(node, jid) & CAN_PUBLISH)
+
+    def invalidate(self, node=None):
+        """Forget the cached policy and decisions for a node, or for every
+        node if none is given."""
+        if node is None:
+            self.policies.clear()
+        else:
+            self.policies.pop(node, None)
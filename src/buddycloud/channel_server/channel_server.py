@@ -2,6 +2,7 @@
 
 """Definition of the buddycloud channel server."""
 
+import errno
 import logging
 import select
 import time
@@ -13,15 +14,27 @@ from xmpp.simplexml import (
     XML2Node,
 )
 
+from buddycloud.channel_server import inbox
+from buddycloud.channel_server.access import (
+    AccessControl,
+    CAN_RETRIEVE,
+)
+from buddycloud.channel_server.request import (
+    NS_PUBSUB_OWNER,
+    NS_RSM,
+    parse_pubsub,
+)
 from buddycloud.channel_server.storage import init_storage
+from buddycloud.channel_server.timestamps import parse_timestamp
+from buddycloud.channel_server.trace import StanzaTracer
 
 
 NS_PUBSUB_EVENT = '%s#event' % xmpp.protocol.NS_PUBSUB
-NS_PUBSUB_OWNER = '%s#owner' % xmpp.protocol.NS_PUBSUB
-NS_RSM = 'http://jabber.org/protocol/rsm'
+NS_PUBSUB_ERRORS = '%s#errors' % xmpp.protocol.NS_PUBSUB
 NS_ATOM = 'http://www.w3.org/2005/Atom'
 NS_THREADS = 'http://purl.org/syndication/thread/1.0'
 NS_ACTIVITY_STREAMS = 'http://activitystrea.ms/spec/1.0/'
+NS_BUDDYCLOUD = 'http://buddycloud.org/v1'
 
 FORM_TYPE_PUBSUB_METADATA = '%s#meta-data' % xmpp.protocol.NS_PUBSUB
 
@@ -64,8 +77,23 @@ BUDDYCLOUD_FIELDS = {
         'label': 'Type of channel',
         'typ': 'text-single'
     },
+    'coalesceWindow': {
+        'name': 'buddycloud#coalesce_window',
+        'label': 'Seconds to gather new items into one notification',
+        'typ': 'text-single'
+    },
+    'coalesceMaxItems': {
+        'name': 'buddycloud#coalesce_max_items',
+        'label': 'Most items to gather into one notification',
+        'typ': 'text-single'
+    },
 }
 
+# The configuration keys an owner may set, keyed on their form field names
+CONFIGURE_FIELDS = dict((field['name'], unicode(key)) for key, field in
+    PUBSUB_FIELDS.items() + BUDDYCLOUD_FIELDS.items()
+    if key != 'creationDate')
+
 
 class ChannelServer(object):
     """XMPP component for buddycloud channel server."""
@@ -92,8 +120,35 @@ class ChannelServer(object):
         # Auth config section
         self.sasl_username = None
         self.secret = None
+        # Logging config section
+        self.tracer = None
+        self.dump_requested = False
         # Storage section
         self.storage = init_storage(config)
+        self.access = AccessControl(self.storage)
+        # PubSub operation handlers, keyed on iq type and the namespace and
+        # name of the operation element
+        self.pubsub_handlers = {
+            ('get', xmpp.protocol.NS_PUBSUB, u'items'):
+                self.xmpp_pubsub_items,
+            ('get', xmpp.protocol.NS_PUBSUB, u'subscriptions'):
+                self.xmpp_pubsub_subscriptions,
+            ('get', NS_PUBSUB_OWNER, u'subscriptions'):
+                self.xmpp_pubsub_subscriptions,
+            ('get', xmpp.protocol.NS_PUBSUB, u'affiliations'):
+                self.xmpp_pubsub_affiliations,
+            ('get', NS_PUBSUB_OWNER, u'affiliations'):
+                self.xmpp_pubsub_affiliations,
+            ('get', NS_BUDDYCLOUD, u'recent-items'):
+                self.xmpp_pubsub_recent_items,
+            ('set', xmpp.protocol.NS_PUBSUB, u'publish'):
+                self.xmpp_pubsub_publish,
+            ('set', NS_PUBSUB_OWNER, u'configure'):
+                self.xmpp_pubsub_configure,
+        }
+        # Notifications waiting on a coalescing window, keyed on node:
+        #     {'node': (deadline, max_items, [(entry_id, entry), ...])}
+        self.pending_notifications = {}
         # Do the set-up
         self._parse_config(config)
 
@@ -108,6 +163,14 @@ class ChannelServer(object):
             config.get('MainServer', 'host'), config.get('MainServer', 'port'))
         self.sasl_username = config.get('Auth', 'sasl_username')
         self.secret = config.get('Auth', 'secret')
+        trace_options = {}
+        for option, name, get in (
+                ('trace_stanzas', 'enabled', config.getboolean),
+                ('trace_sample_every', 'sample_every', config.getint),
+                ('trace_buffer_size', 'size', config.getint)):
+            if config.has_option('Logging', option):
+                trace_options[name] = get('Logging', option)
+        self.tracer = StanzaTracer(**trace_options)
         self.logger.debug('Configuration: %s',
             dict(((prop, self.__dict__.get(prop)) for prop in (
                 'jid', 'allow_register', 'component_binding', 'route_wrap',
@@ -115,17 +178,17 @@ class ChannelServer(object):
 
     def register_handlers(self):
         """Register handlers for the various XMPP stanzas."""
-        self.connection.RegisterHandler('message', self.xmpp_message)
-        self.connection.RegisterHandler('presence', self.xmpp_presence)
-        self.connection.RegisterHandler(
-            'iq', self.xmpp_pubsub_get, typ='get', ns=xmpp.protocol.NS_PUBSUB)
-        self.connection.RegisterHandler(
-            'iq', self.xmpp_pubsub_get, typ='get', ns=NS_PUBSUB_OWNER)
-        self.connection.RegisterHandler(
-            'iq', self.xmpp_pubsub_set, typ='set', ns=xmpp.protocol.NS_PUBSUB)
-        self.connection.RegisterHandler(
-            'iq', self.xmpp_register_set, typ='set',
-            ns=xmpp.protocol.NS_REGISTER)
+        trace = self.tracer.wrap
+        self.connection.RegisterHandler('message', trace(self.xmpp_message))
+        self.connection.RegisterHandler('presence', trace(self.xmpp_presence))
+        pubsub = trace(self.xmpp_pubsub)
+        for typ in ('get', 'set'):
+            self.connection.RegisterHandler('iq', pubsub,
+                typ=typ, ns=xmpp.protocol.NS_PUBSUB)
+            self.connection.RegisterHandler('iq', pubsub,
+                typ=typ, ns=NS_PUBSUB_OWNER)
+        self.connection.RegisterHandler('iq', trace(self.xmpp_register_set),
+            typ='set', ns=xmpp.protocol.NS_REGISTER)
         self.disco = xmpp.browser.Browser()
         self.disco.PlugIn(self.connection)
         self.disco.setDiscoHandler(self.xmpp_base_disco, node='', jid=self.jid)
@@ -138,94 +201,267 @@ class ChannelServer(object):
         """Callback to handle XMPP presence stanzas."""
         self.logger.debug(event)
 
-    def xmpp_pubsub_get(self, conn, event):
-        """Callback to handle XMPP PubSub queries."""
-        self.logger.debug('Pubsub request: %s', ustr(event))
-        tag = event.getTag('pubsub')
-        if tag and (tag.getNamespace() == xmpp.protocol.NS_PUBSUB or
-                tag.getNamespace() == NS_PUBSUB_OWNER):
-            child = tag.getChildren()[0]
-            op = child.getName()
-            node = child.getAttr('node')
-            #rsm = tag.getTag('set', namespace=NS_RSM)
-            #set_size = int(rsm.getTagData('max'))
-            channel = self.storage.get_node(node)
-            self.logger.debug(
-                'Got channel entries for node %s: %s', node, channel)
-            if channel is None:
-                conn.send(xmpp.protocol.Error(event, xmpp.ERR_ITEM_NOT_FOUND)) 
-                raise xmpp.protocol.NodeProcessed
-            reply = event.buildReply('result')
-            if op == u'items':
-                pubsub = reply.setTag('pubsub',
-                        namespace=xmpp.protocol.NS_PUBSUB)
-                items = pubsub.setTag('items', attrs={'node': node})
-                for channel_item in sorted(
-                        channel.items, key=lambda x: x.updated, reverse=True):
-                    item = items.setTag('item', attrs={'id': channel_item.id})
-                    item.addChild(node=XML2Node(channel_item.xml))
-            elif op == u'subscriptions':
-                pubsub = reply.setTag('pubsub',
-                        namespace=NS_PUBSUB_OWNER)
-                subscriptions = pubsub.setTag(
-                    u'subscriptions', attrs={u'node': node})
-                for channel_item in channel.subscriptions:
-                    subscriptions.setTag(u'subscription', attrs={
-                        u'jid': channel_item.user,
-                        u'subscription': channel_item.subscription})
-            elif op == u'affiliations':
-                pubsub = reply.setTag('pubsub',
-                        namespace=NS_PUBSUB_OWNER)
-                affiliations = pubsub.setTag(u'affiliations')
-                for channel_item in channel.affiliations:
-                    affiliations.setTag(u'affiliation', attrs={
-                        u'jid': channel_item.user,
-                        u'affiliation': channel_item.affiliation
-                    })
-            #rsm = pubsub.setTag('set', namespace=NS_RSM)
-            #if len(resultset) > 0:
-            #    rsm.setTagData('first', resultset[0].id if op == u'items' else
-            #        resultset[0].user, attrs={'index': 0})
-            #    rsm.setTagData('last', resultset[-1].id if op == u'items' else
-            #        resultset[-1].jid)
-            #rsm.setTagData('count', len(resultset))
-            conn.send(reply)
+    def xmpp_pubsub(self, conn, event):
+        """Callback to handle XMPP PubSub queries and commands.
+
+        The request is parsed once and handed to the handler for its
+        operation."""
+        self.logger.debug('Pubsub request: %s', event)
+        request = parse_pubsub(event)
+        if request is None:
+            return
+        handler = self.pubsub_handlers.get(
+            (request.typ, request.op_namespace, request.op))
+        if handler is None:
+            conn.send(xmpp.protocol.Error(
+                event, xmpp.ERR_FEATURE_NOT_IMPLEMENTED))
             raise xmpp.protocol.NodeProcessed
+        handler(conn, event, request)
 
-    def xmpp_pubsub_set(self, conn, event):
-        """Callback to handle XMPP PubSub commands."""
-        self.logger.debug('Pubsub command: %s', event)
-        self.logger.debug('Decoded event Node: %s', ustr(event))
-        tag = event.getTag('pubsub')
-        if tag and tag.getNamespace() == xmpp.protocol.NS_PUBSUB:
-            publish = tag.getTag('publish')
-            node = publish.getAttr('node')
-            jid = publish.getAttr('jid')
-            # TODO Check the sending JID can post to the JID/node
-            entry = publish.getTag('item').getTag('entry')
-            entry_id = str(uuid.uuid4())
-            author = entry.getTag('author')
-            author.setTagData('uri', 'acct:%s' % author.getTagData('name'))
-            entry.setTagData('id', entry_id)
-            entry.setTagData('published', entry.getTagData('updated'))
-            entry.setTag('link', attrs={'rel': 'self', 'href':
-                'xmpp:%s?pubsub;action=retrieve;node=%s;item=%s' % (self.jid,
-                    node, entry_id)})
-            self.storage.add_item(node, entry_id, ustr(entry))
-            reply = event.buildReply('result')
-            pubsub = reply.setTag('pubsub', namespace=xmpp.protocol.NS_PUBSUB)
-            publish = pubsub.setTag('publish', attrs={'node': node})
-            publish.setTag('item', attrs={'id': entry_id})
-            conn.send(reply)
-            for subscription in self.storage.get_node(node).subscriptions:
-                message = xmpp.protocol.Message(
-                    typ='headline', frm=self.jid, to=subscription.user)
-                event = message.setTag('event', namespace=NS_PUBSUB_EVENT)
-                items = event.setTag('items', attrs={'node': node})
-                item = items.setTag('item', attrs={'id': entry_id})
-                item.addChild(node=entry)
-                conn.send(message)
+    def _require_node(self, conn, event, request):
+        """Refuse a request that does not name a node."""
+        if not request.node:
+            error = xmpp.protocol.Error(event, xmpp.ERR_BAD_REQUEST)
+            error.getTag('error').addChild(
+                'nodeid-required', namespace=NS_PUBSUB_ERRORS)
+            conn.send(error)
+            raise xmpp.protocol.NodeProcessed
+
+    def _get_readable_node(self, conn, event, request):
+        """Get the cached policy of the requested node, checking the sender
+        may read it."""
+        self._require_node(conn, event, request)
+        policy = self.access.policy(request.node)
+        if policy is None:
+            conn.send(xmpp.protocol.Error(event, xmpp.ERR_ITEM_NOT_FOUND)) 
+            raise xmpp.protocol.NodeProcessed
+        if not policy.permissions(
+                unicode(event.getFrom().getStripped())) & CAN_RETRIEVE:
+            conn.send(xmpp.protocol.Error(event, xmpp.ERR_FORBIDDEN))
+            raise xmpp.protocol.NodeProcessed
+        return policy
+
+    def xmpp_pubsub_items(self, conn, event, request):
+        """Callback to handle XMPP PubSub item retrieval, newest first and
+        paged with RSM if asked.  If item IDs are given, only those items
+        are returned."""
+        self._get_readable_node(conn, event, request)
+        try:
+            limit = int(request.rsm_max) if request.rsm_max else None
+            if limit is not None and limit < 1:
+                raise ValueError('max must be at least 1')
+            after = None
+            if request.rsm_after:
+                updated, item_id = request.rsm_after.rsplit(u'|', 1)
+                after = (parse_timestamp(updated), item_id)
+        except ValueError:
+            conn.send(xmpp.protocol.Error(event, xmpp.ERR_BAD_REQUEST))
             raise xmpp.protocol.NodeProcessed
+        page = list(self.storage.get_items(request.node, limit=limit,
+            after=after, ids=request.item_ids or None))
+        reply = event.buildReply('result')
+        pubsub = reply.setTag('pubsub', namespace=xmpp.protocol.NS_PUBSUB)
+        items = pubsub.setTag('items', attrs={'node': request.node})
+        for channel_item in page:
+            item = items.addChild('item', attrs={'id': channel_item.id})
+            item.addChild(node=XML2Node(channel_item.xml))
+        if page:
+            rsm = pubsub.setTag('set', namespace=NS_RSM)
+            rsm.setTagData('first', u'%s|%s' % (
+                page[0].updated.isoformat(), page[0].id))
+            rsm.setTagData('last', u'%s|%s' % (
+                page[-1].updated.isoformat(), page[-1].id))
+        conn.send(reply)
+        raise xmpp.protocol.NodeProcessed
+
+    def xmpp_pubsub_subscriptions(self, conn, event, request):
+        """Callback to handle XMPP PubSub subscription list queries.
+
+        Without a node, the sender's own subscriptions are listed."""
+        if not request.node and request.op_namespace != NS_PUBSUB_OWNER:
+            self.xmpp_pubsub_own_subscriptions(conn, event)
+        policy = self._get_readable_node(conn, event, request)
+        reply = event.buildReply('result')
+        pubsub = reply.setTag('pubsub', namespace=NS_PUBSUB_OWNER)
+        subscriptions = pubsub.setTag(
+            u'subscriptions', attrs={u'node': request.node})
+        for user, subscription in sorted(policy.subscriptions.items()):
+            subscriptions.setTag(u'subscription', attrs={
+                u'jid': user, u'subscription': subscription})
+        conn.send(reply)
+        raise xmpp.protocol.NodeProcessed
+
+    def xmpp_pubsub_own_subscriptions(self, conn, event):
+        """Reply with the sender's subscriptions across all nodes."""
+        fromjid = unicode(event.getFrom().getStripped())
+        reply = event.buildReply('result')
+        pubsub = reply.setTag('pubsub', namespace=xmpp.protocol.NS_PUBSUB)
+        subscriptions = pubsub.setTag(u'subscriptions')
+        for subscription in self.storage.get_subscriptions(fromjid):
+            subscriptions.addChild(u'subscription', attrs={
+                u'node': subscription.node,
+                u'jid': subscription.user,
+                u'subscription': subscription.subscription})
+        conn.send(reply)
+        raise xmpp.protocol.NodeProcessed
+
+    def xmpp_pubsub_affiliations(self, conn, event, request):
+        """Callback to handle XMPP PubSub affiliation list queries."""
+        policy = self._get_readable_node(conn, event, request)
+        reply = event.buildReply('result')
+        pubsub = reply.setTag('pubsub', namespace=NS_PUBSUB_OWNER)
+        affiliations = pubsub.setTag(u'affiliations')
+        for user, affiliation in sorted(policy.affiliations.items()):
+            affiliations.setTag(u'affiliation', attrs={
+                u'jid': user,
+                u'affiliation': affiliation
+            })
+        conn.send(reply)
+        raise xmpp.protocol.NodeProcessed
+
+    def xmpp_pubsub_recent_items(self, conn, event, request):
+        """Callback to handle inbox queries for the newest items across all
+        of the sender's subscriptions."""
+        fromjid = unicode(event.getFrom().getStripped())
+        try:
+            since = request.element.getAttr('since')
+            since = parse_timestamp(since) if since else None
+            per_node = request.element.getAttr('max')
+            per_node = int(per_node) if per_node else None
+            page_size = (int(request.rsm_max) if request.rsm_max
+                else inbox.DEFAULT_PAGE_SIZE)
+            if page_size < 1 or (per_node is not None and per_node < 1):
+                raise ValueError('max must be at least 1')
+            page = inbox.recent_items(self.storage, self.access, fromjid,
+                since, request.rsm_after, page_size, per_node)
+        except ValueError:
+            conn.send(xmpp.protocol.Error(event, xmpp.ERR_BAD_REQUEST))
+            raise xmpp.protocol.NodeProcessed
+        reply = event.buildReply('result')
+        pubsub = reply.setTag('pubsub', namespace=xmpp.protocol.NS_PUBSUB)
+        items = None
+        for channel_item in page:
+            if items is None or items.getAttr('node') != channel_item.node:
+                items = pubsub.addChild(
+                    'items', attrs={'node': channel_item.node})
+            item = items.addChild('item', attrs={'id': channel_item.id})
+            item.addChild(node=XML2Node(channel_item.xml))
+        if page:
+            rsm = pubsub.setTag('set', namespace=NS_RSM)
+            rsm.setTagData('first', inbox.make_cursor(page[0]))
+            rsm.setTagData('last', inbox.make_cursor(page[-1]))
+        conn.send(reply)
+        raise xmpp.protocol.NodeProcessed
+
+    def xmpp_pubsub_publish(self, conn, event, request):
+        """Callback to handle XMPP PubSub publish commands."""
+        self._require_node(conn, event, request)
+        node = request.node
+        fromjid = unicode(event.getFrom().getStripped())
+        if not self.access.can_publish(node, fromjid):
+            error = (xmpp.ERR_FORBIDDEN if self.access.policy(node)
+                else xmpp.ERR_ITEM_NOT_FOUND)
+            conn.send(xmpp.protocol.Error(event, error))
+            raise xmpp.protocol.NodeProcessed
+        entry = request.entry
+        author = request.entry_fields.get('author')
+        if entry is None or author is None:
+            conn.send(xmpp.protocol.Error(event, xmpp.ERR_BAD_REQUEST))
+            raise xmpp.protocol.NodeProcessed
+        updated = request.entry_fields.get('updated')
+        entry_id = str(uuid.uuid4())
+        author.setTagData('uri', 'acct:%s' % author.getTagData('name'))
+        entry.setTagData('id', entry_id)
+        entry.setTagData('published',
+            updated.getData() if updated is not None else None)
+        entry.setTag('link', attrs={'rel': 'self', 'href':
+            'xmpp:%s?pubsub;action=retrieve;node=%s;item=%s' % (self.jid,
+                node, entry_id)})
+        self.storage.add_item(node, entry_id, ustr(entry))
+        reply = event.buildReply('result')
+        pubsub = reply.setTag('pubsub', namespace=xmpp.protocol.NS_PUBSUB)
+        publish = pubsub.setTag('publish', attrs={'node': node})
+        publish.setTag('item', attrs={'id': entry_id})
+        conn.send(reply)
+        self.queue_notification(node, entry_id, entry)
+        raise xmpp.protocol.NodeProcessed
+
+    def xmpp_pubsub_configure(self, conn, event, request):
+        """Callback to handle XMPP PubSub node configuration by the node's
+        owner."""
+        self._require_node(conn, event, request)
+        fromjid = unicode(event.getFrom().getStripped())
+        policy = self.access.policy(request.node)
+        if policy is None:
+            conn.send(xmpp.protocol.Error(event, xmpp.ERR_ITEM_NOT_FOUND))
+            raise xmpp.protocol.NodeProcessed
+        if policy.affiliations.get(fromjid) != u'owner':
+            conn.send(xmpp.protocol.Error(event, xmpp.ERR_FORBIDDEN))
+            raise xmpp.protocol.NodeProcessed
+        form = request.element.getTag('x', namespace=xmpp.protocol.NS_DATA)
+        if form is None:
+            conn.send(xmpp.protocol.Error(event, xmpp.ERR_BAD_REQUEST))
+            raise xmpp.protocol.NodeProcessed
+        config = {}
+        if form.getAttr('type') != 'cancel':
+            for field in form.getTags('field'):
+                name = field.getAttr('var')
+                if name == 'FORM_TYPE':
+                    continue
+                if name not in CONFIGURE_FIELDS:
+                    conn.send(xmpp.protocol.Error(
+                        event, xmpp.ERR_NOT_ACCEPTABLE))
+                    raise xmpp.protocol.NodeProcessed
+                config[CONFIGURE_FIELDS[name]] = unicode(
+                    field.getTagData('value') or u'')
+        if config:
+            self.storage.set_node_config(request.node, config)
+        conn.send(event.buildReply('result'))
+        raise xmpp.protocol.NodeProcessed
+
+    def queue_notification(self, node, entry_id, entry):
+        """Notify subscribers of a new item, or hold it back to be sent
+        along with others if the node has a coalescing window."""
+        pending = self.pending_notifications.get(node)
+        if pending is None:
+            policy = self.access.policy(node)
+            window = policy.coalesce_window
+            max_items = policy.coalesce_max_items
+            if window <= 0 or max_items <= 1:
+                self.send_notification(node, [(entry_id, entry)])
+                return
+            pending = (time.time() + window, max_items, [])
+            self.pending_notifications[node] = pending
+        deadline, max_items, entries = pending
+        entries.append((entry_id, entry))
+        if len(entries) >= max_items:
+            del self.pending_notifications[node]
+            self.send_notification(node, entries)
+
+    def flush_notifications(self, force=False):
+        """Send any held-back notifications whose window has closed."""
+        now = time.time()
+        for node, (deadline, max_items, entries) in \
+                self.pending_notifications.items():
+            if force or deadline <= now:
+                del self.pending_notifications[node]
+                self.send_notification(node, entries)
+
+    def send_notification(self, node, entries):
+        """Send a single event message carrying the given items to each
+        subscriber of the node that may retrieve them."""
+        policy = self.access.policy(node)
+        if policy is None:
+            return
+        for user in policy.subscribers():
+            message = xmpp.protocol.Message(
+                typ='headline', frm=self.jid, to=user)
+            event = message.setTag('event', namespace=NS_PUBSUB_EVENT)
+            items = event.setTag('items', attrs={'node': node})
+            for entry_id, entry in entries:
+                item = items.addChild('item', attrs={'id': entry_id})
+                item.addChild(node=entry)
+            self.connection.send(message)
 
     def xmpp_register_set(self, conn, event):
         """Callback to handle XMPP register commands."""
@@ -247,11 +483,20 @@ class ChannelServer(object):
             conn.send(reply)
             raise xmpp.protocol.NodeProcessed
 
+    def dump_trace(self):
+        """Log the stanzas recorded by the tracer.
+
+        They are logged as warnings, so that they are shown at the usual log
+        levels."""
+        lines = self.tracer.dump()
+        self.logger.warn('Dumping %d traced stanzas', len(lines))
+        for line in lines:
+            self.logger.warn('Trace: %s', line)
+
     def xmpp_connect(self):
         """Connect to the XMPP server."""
         self.connection = xmpp.client.Component(self.jid, self.main_server[0],
-            self.main_server[1], debug=['always', 'nodebuilder'] if
-            self.logger.level == logging.DEBUG else [],
+            self.main_server[1], debug=[],
             sasl=self.sasl_username is None,
             bind=self.component_binding, route=self.route_wrap)
 
@@ -345,9 +590,18 @@ class ChannelServer(object):
                 self.xmpp_disconnect()
             except xmpp.protocol.UnsupportedStanzaType, err:
                 self.logger.warn('Unsupported stanza type received: %s', err)
-            except select.error:
-                break
+            except select.error, err:
+                # A signal, such as the one to dump the trace, interrupts
+                # the select; anything else is fatal.
+                if err.args[0] != errno.EINTR:
+                    break
             if not self.connection.isConnected():
                 self.xmpp_disconnect()
+            self.flush_notifications()
+            self.storage.end_reads()
+            if self.dump_requested:
+                self.dump_requested = False
+                self.dump_trace()
+        self.flush_notifications(force=True)
         self.connection.disconnect()
         self.storage.shutdown()
@@ -0,0 +1,96 @@
+# Copyright 2012 James Tait - All Rights Reserved
+
+"""Inbox of recent items across a user's subscriptions."""
+
+import heapq
+
+from datetime import datetime
+
+from buddycloud.channel_server.timestamps import parse_timestamp
+
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# The number of items read from a node at a time.
+NODE_PAGE_SIZE = 10
+
+
+def _sort_key(item):
+    """Key putting items newest first, ties broken on node and ID."""
+    return (datetime.max - item.updated, item.node, item.id)
+
+
+def make_cursor(item):
+    """Make the RSM cursor for an item in the inbox."""
+    return u'%s|%s|%s' % (item.updated.isoformat(), item.node, item.id)
+
+
+def parse_cursor(cursor):
+    """Turn an RSM cursor back into the timestamp and sort key of the item it
+    was made from."""
+    updated, rest = cursor.split(u'|', 1)
+    node, item_id = rest.rsplit(u'|', 1)
+    updated = parse_timestamp(updated)
+    return updated, (datetime.max - updated, node, item_id)
+
+
+def node_items(storage, node, since, until, limit):
+    """Generate up to `limit` of a node's newest items, reading them from
+    storage a page at a time as they are asked for."""
+    after = None
+    while limit > 0:
+        page_size = min(limit, NODE_PAGE_SIZE)
+        page = list(storage.get_items(node, since, until, page_size, after))
+        for item in page:
+            yield item
+        if len(page) < page_size:
+            break
+        limit -= page_size
+        after = (page[-1].updated, page[-1].id)
+
+
+def merge_newest_first(streams):
+    """Merge item streams that are each newest first into a single stream
+    that is newest first."""
+    heap = []
+    for stream in streams:
+        stream = iter(stream)
+        for item in stream:
+            heap.append((_sort_key(item), item, stream))
+            break
+    heapq.heapify(heap)
+    while heap:
+        key, item, stream = heap[0]
+        yield item
+        for item in stream:
+            heapq.heapreplace(heap, (_sort_key(item), item, stream))
+            break
+        else:
+            heapq.heappop(heap)
+
+
+def recent_items(storage, access, jid, since=None, after=None,
+        page_size=DEFAULT_PAGE_SIZE, per_node=None):
+    """Get a page of the newest items across all the nodes the JID is
+    subscribed to and may retrieve from.
+
+    `after` is the cursor of the last item of the previous page.  At most
+    `per_node` items are taken from any one node.
+    """
+    page_size = min(page_size, MAX_PAGE_SIZE)
+    limit = page_size if per_node is None else min(per_node, page_size)
+    until, after_key = None, None
+    if after is not None:
+        until, after_key = parse_cursor(after)
+    nodes = [s.node for s in storage.get_subscriptions(jid)]
+    streams = [node_items(storage, node, since, until, limit)
+        for node in nodes if access.can_retrieve(node, jid)]
+    page = []
+    for item in merge_newest_first(streams):
+        if after_key is not None and _sort_key(item) <= after_key:
+            continue
+        page.append(item)
+        if len(page) >= page_size:
+            break
+    return page
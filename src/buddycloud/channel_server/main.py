@@ -20,6 +20,11 @@ def sigHandler(signum, frame):
     channel_server.is_online = False
 
 
+def traceHandler(signum, frame):
+    """Signal handler to have the stanza trace dumped."""
+    channel_server.dump_requested = True
+
+
 if __name__ == '__main__':
     parser = OptionParser('%prog [options]')
     parser.add_option('--config', dest='config_file',
@@ -51,4 +56,6 @@ if __name__ == '__main__':
     # Set the signal handlers
     signal.signal(signal.SIGINT, sigHandler)
     signal.signal(signal.SIGTERM, sigHandler)
+    signal.signal(signal.SIGUSR1, traceHandler)
+    signal.siginterrupt(signal.SIGUSR1, False)
     channel_server.run()
@@ -0,0 +1,86 @@
+# Copyright 2012 James Tait - All Rights Reserved
+
+"""Parsing of PubSub requests for buddycloud channel server."""
+
+import xmpp
+
+
+NS_PUBSUB_OWNER = '%s#owner' % xmpp.protocol.NS_PUBSUB
+NS_RSM = 'http://jabber.org/protocol/rsm'
+
+PUBSUB_NAMESPACES = frozenset([xmpp.protocol.NS_PUBSUB, NS_PUBSUB_OWNER])
+
+
+class PubsubRequest(object):
+    """A PubSub iq, picked apart in a single pass over its payload.
+
+    `op` and `op_namespace` are the name and namespace of the operation
+    element (items, publish and so on) and `element` the element itself.
+    For a publish, `entry` is the first Atom entry and `entry_fields` maps
+    the names of its children to the first child with each name.  For an
+    items request, `item_ids` lists the IDs of the items asked for, if any.
+    """
+
+    def __init__(self, typ, namespace):
+        self.typ = typ
+        self.namespace = namespace
+        self.op = None
+        self.op_namespace = None
+        self.element = None
+        self.node = None
+        self.entry = None
+        self.entry_fields = {}
+        self.item_ids = []
+        self.rsm_max = None
+        self.rsm_after = None
+
+
+def parse_pubsub(event):
+    """Parse a PubSub iq into a PubsubRequest.
+
+    Returns None if the iq has no PubSub payload or no operation.
+    """
+    for pubsub in event.getChildren():
+        if (pubsub.getName() == 'pubsub' and
+                pubsub.getNamespace() in PUBSUB_NAMESPACES):
+            break
+    else:
+        return None
+    request = PubsubRequest(event.getType(), pubsub.getNamespace())
+    for child in pubsub.getChildren():
+        name = child.getName()
+        if name == 'set' and child.getNamespace() == NS_RSM:
+            for rsm in child.getChildren():
+                rsm_name = rsm.getName()
+                if rsm_name == 'max':
+                    request.rsm_max = rsm.getData()
+                elif rsm_name == 'after':
+                    request.rsm_after = rsm.getData()
+        elif request.op is None:
+            request.op = name
+            # Elements built in code rather than parsed have no namespace
+            # of their own, so inherit it as XML would.
+            request.op_namespace = child.getNamespace() or request.namespace
+            request.element = child
+            request.node = child.getAttr('node')
+            if name == 'items':
+                request.item_ids = [item.getAttr('id')
+                    for item in child.getChildren()
+                    if item.getName() == 'item' and item.getAttr('id')]
+                continue
+            if name != 'publish':
+                continue
+            for item in child.getChildren():
+                if item.getName() != 'item':
+                    continue
+                for payload in item.getChildren():
+                    if payload.getName() == 'entry':
+                        request.entry = payload
+                        break
+                break
+    if request.op is None:
+        return None
+    if request.entry is not None:
+        for field in request.entry.getChildren():
+            request.entry_fields.setdefault(field.getName(), field)
+    return request
@@ -3,6 +3,13 @@
 """Storage module for buddycloud channel server."""
 
 
+# Node configuration used when a node does not set its own.
+DEFAULT_CONFIG = {
+    u'accessModel': u'open',
+    u'defaultAffiliation': u'member',
+    u'publishModel': u'publishers',
+}
+
 def init_storage(config):
     """Initialise the storage module."""
     backend = config.get('Storage', 'backend')
@@ -21,6 +28,22 @@ def init_storage(config):
 class StorageBackend(object):
     """Base class for storage back-ends."""
 
+    def __init__(self):
+        self.change_listeners = []
+
+    def add_change_listener(self, listener):
+        """Register a callable to be given the name of each node whose
+        configuration, affiliations or subscriptions are written."""
+        self.change_listeners.append(listener)
+
+    def node_changed(self, node):
+        """Tell the change listeners that the given node has been written.
+
+        Back-ends must call this after every write to a node's configuration,
+        affiliations or subscriptions."""
+        for listener in self.change_listeners:
+            listener(node)
+
     def set_config(self, **kwargs):
         """Set the configuration of this storage back-end."""
         pass
@@ -33,6 +56,11 @@ class StorageBackend(object):
         """Create a PubSub node with the given configuration."""
         raise NotImplementedError()
 
+    def set_node_config(self, node, config):
+        """Set the given configuration keys of a PubSub node, leaving the
+        others as they are."""
+        raise NotImplementedError()
+
     def get_nodes(self):
         """Get a list of all the available PubSub nodes."""
         raise NotImplementedError()
@@ -45,6 +73,37 @@ class StorageBackend(object):
         """Add an item to the requested PubSub node."""
         raise NotImplementedError()
 
+    def get_subscriptions(self, jid):
+        """Get the active subscriptions of the given JID across all nodes."""
+        raise NotImplementedError()
+
+    def get_items(self, node, since=None, until=None, limit=None,
+            after=None, ids=None):
+        """Get the items of a PubSub node, newest first, ties broken on ID.
+
+        Only items updated after `since` and no later than `until` are
+        returned, if they are given, and at most `limit` of them.  `after` is
+        the (updated, id) of the last item of a previous call, to page
+        through a node without holding all of its items at once.  If `ids`
+        is given, only the items with those IDs are returned.
+        """
+        raise NotImplementedError()
+
+    def add_records(self, records):
+        """Add a chunk of exported records in a single transaction.
+
+        Each record is a dictionary whose 'type' is one of 'node', 'config',
+        'affiliation', 'subscription' or 'item'; the remaining keys are the
+        attributes of that object.
+        """
+        raise NotImplementedError()
+
+    def end_reads(self):
+        """End any read transactions left open by the objects handed out
+        since the last call.  The server calls this after every turn of its
+        loop."""
+        pass
+
     def shutdown(self):
         """Shut down the storage module - close any open resources, flush any
         pending data and so on."""
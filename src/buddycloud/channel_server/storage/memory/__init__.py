@@ -25,6 +25,7 @@ class MemoryStorageBackend(StorageBackend):
         {'node_id': {'entry_id': (timestamp, entry_node)}}"""
 
     def __init__(self):
+        super(MemoryStorageBackend, self).__init__()
         self.temp_entry_store = {}
 
     def get_nodes(self):
@@ -7,12 +7,20 @@ import logging
 
 from datetime import datetime
 
+from storm.exceptions import StormError
 from storm.locals import (
+    And,
     create_database,
+    Desc,
+    Or,
     Store,
 )
+from storm.uri import URI
 
-from buddycloud.channel_server.storage import StorageBackend
+from buddycloud.channel_server.storage import (
+    DEFAULT_CONFIG,
+    StorageBackend,
+)
 from buddycloud.channel_server.storage.storm.model import (
     Affiliation,
     Item,
@@ -20,12 +28,19 @@ from buddycloud.channel_server.storage.storm.model import (
     NodeConfig,
     Subscription,
 )
+from buddycloud.channel_server.storage.storm.schema import (
+    CREATE_PATCH,
+    schema,
+)
 
 
-DEFAULT_CONFIG = {
-    u'accessModel': u'open',
-    u'defaultAffiliation': u'member',
-    u'publishModel': u'publishers',
+# Defaults for embedded SQLite databases.  WAL lets readers carry on while the
+# writer commits, and NORMAL synchronous is durable enough under WAL.
+SQLITE_DEFAULTS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': '-16000',
+    'mmap_size': '268435456',
 }
 
 
@@ -33,13 +48,12 @@ class StormStorageBackend(StorageBackend):
     """Storage back-end based on the Storm ORM framework."""
 
     def __init__(self):
+        super(StormStorageBackend, self).__init__()
         self.store = None
+        self.reader = None
 
     def set_config(self, **kwargs):
         """Set the configuration of this back-end."""
-        uri = kwargs['uri']
-        database = create_database(uri)
-        self.store = Store(database)
         self.logger = logging.getLogger('StormStorageBackend')
         handler = logging.StreamHandler()
         formatter = logging.Formatter(kwargs['log_format'])
@@ -47,6 +61,89 @@ class StormStorageBackend(StorageBackend):
         self.logger.addHandler(handler)
         self.logger.setLevel(
             logging.__getattribute__(kwargs['log_level']))
+        uri = URI(kwargs['uri'])
+        if uri.scheme == 'sqlite':
+            self._set_sqlite_config(uri, kwargs)
+        else:
+            database = create_database(uri)
+            self.store = Store(database)
+            self.reader = self.store
+        default = 'True' if uri.scheme == 'sqlite' else 'False'
+        if kwargs.get('create_schema', default).lower() in (
+                '1', 'yes', 'true', 'on'):
+            self.logger.debug('Creating or upgrading schema in %s',
+                uri.database)
+            self._upgrade_schema()
+
+    def _set_sqlite_config(self, uri, kwargs):
+        """Set up an embedded SQLite database.
+
+        The writer and the reader get their own connection; under WAL the
+        reader sees the last committed state without waiting on the writer.
+        The server handles one stanza at a time, so a single reader is
+        enough.  An in-memory database cannot be shared between connections,
+        so in that case all reads go through the writer store.
+        """
+        options = dict(SQLITE_DEFAULTS)
+        options.update((key, value) for key, value in kwargs.items()
+            if key in SQLITE_DEFAULTS)
+        in_memory = uri.database in (None, '', ':memory:')
+        if not in_memory:
+            uri.options.setdefault('journal_mode', options['journal_mode'])
+        uri.options.setdefault('synchronous', options['synchronous'])
+        database = create_database(uri)
+        self.store = Store(database)
+        self._set_pragmas(self.store, options)
+        if in_memory:
+            self.reader = self.store
+        else:
+            self.reader = Store(database)
+            self._set_pragmas(self.reader, options)
+
+    def _upgrade_schema(self):
+        """Create the schema, or bring it up to date.
+
+        Tables made by hand, before the schema was managed here, have no
+        patch table.  Storm would take that to mean an empty database and
+        create every table again, so they are instead recorded as being at
+        the schema from before the first patch and patched from there.
+        """
+        if self._has_table('nodes') and not self._has_table('patch'):
+            self.logger.info('Taking on existing tables for patching')
+            self.store.execute(CREATE_PATCH)
+            self.store.commit()
+        schema.upgrade(self.store)
+
+    def _has_table(self, table):
+        """Check whether the database has the given table."""
+        try:
+            self.store.execute('SELECT 1 FROM %s WHERE 1 = 0' % table)
+        except StormError:
+            return False
+        finally:
+            self.store.rollback()
+        return True
+
+    def _set_pragmas(self, store, options):
+        """Apply the per-connection SQLite cache pragmas to a store."""
+        store.execute('PRAGMA cache_size = %d' % int(options['cache_size']))
+        store.execute('PRAGMA mmap_size = %d' % int(options['mmap_size']))
+        store.commit()
+
+    def _reader(self):
+        """Get the reader store, with a fresh view of everything the writer
+        has committed."""
+        self.end_reads()
+        return self.reader
+
+    def end_reads(self):
+        """End the reader's transaction.
+
+        An open read transaction pins its snapshot of the database, and under
+        WAL no checkpoint can get past it, so the log grows until it ends.
+        """
+        if self.reader is not self.store:
+            self.reader.rollback()
 
     def create_node(self, node, jid, node_config):
         """Create a PubSub node with the given configuration.
@@ -54,8 +151,8 @@ class StormStorageBackend(StorageBackend):
         Creates the Node, NodeConfig, Affiliation and Subscription model for
         the given node.
         """
-        self.logger.debug('Creating node %s for jid %s with config %s' %
-            (node, jid, node_config))
+        self.logger.debug('Creating node %s for jid %s with config %s',
+            node, jid, node_config)
         new_node = Node(node)
         self.store.add(new_node)
         config = copy.deepcopy(DEFAULT_CONFIG)
@@ -69,6 +166,7 @@ class StormStorageBackend(StorageBackend):
         subscription = Subscription(node, jid, jid, u'subscribed',
                 datetime.utcnow())
         self.store.add(subscription)
+        self.node_changed(node)
 
     def create_channel(self, jid):
         """Create a channel for the given JID.
@@ -76,7 +174,7 @@ class StormStorageBackend(StorageBackend):
         Creates all the required PubSub nodes that constitute a channel, with
         the appropriate permissions.
         """
-        self.logger.debug('Creating channel for %s' % jid)
+        self.logger.debug('Creating channel for %s', jid)
         creation_date = unicode(datetime.utcnow().isoformat())
         self.create_node(u'/user/%s/posts' % jid, jid,
             {u'channelType': u'personal',
@@ -106,18 +204,34 @@ class StormStorageBackend(StorageBackend):
                 u'title': u'%s subscriptions' % jid})
         self.store.commit()
 
+    def set_node_config(self, node, config):
+        """Set the given configuration keys of a PubSub node, leaving the
+        others as they are."""
+        self.logger.debug('Setting config of node %s to %s', node, config)
+        now = datetime.utcnow()
+        for key, value in config.items():
+            node_config = self.store.get(NodeConfig, (node, key))
+            if node_config is None:
+                node_config = NodeConfig(node, key, value)
+                self.store.add(node_config)
+            else:
+                node_config.value = value
+            node_config.updated = now
+        self.store.commit()
+        self.node_changed(node)
+
     def get_node(self, node):
         """Get the requested PubSub node."""
-        self.logger.debug('Getting node %s' % node)
-        the_node = self.store.get(Node, node)
-        self.logger.debug('Returning node %s' % the_node)
+        self.logger.debug('Getting node %s', node)
+        the_node = self._reader().get(Node, node)
+        self.logger.debug('Returning node %s', the_node)
         return the_node
 
     def get_nodes(self):
         """Get a list of all the available PubSub nodes."""
         self.logger.debug('Getting list of available nodes.')
-        node_list = self.store.find(Node)
-        self.logger.debug('Returning list of available node %s' % node_list)
+        node_list = self._reader().find(Node)
+        self.logger.debug('Returning list of available node %s', node_list)
         return node_list
 
     def add_item(self, node, item_id, item):
@@ -126,9 +240,75 @@ class StormStorageBackend(StorageBackend):
         self.store.add(new_item)
         self.store.commit()
 
+    def get_subscriptions(self, jid):
+        """Get the active subscriptions of the given JID across all nodes."""
+        self.logger.debug('Getting subscriptions for %s', jid)
+        subscriptions = list(self._reader().find(Subscription,
+            Subscription.user == jid,
+            Subscription.subscription == u'subscribed'))
+        self.end_reads()
+        return subscriptions
+
+    def get_items(self, node, since=None, until=None, limit=None,
+            after=None, ids=None):
+        """Get the items of a PubSub node, newest first, ties broken on ID."""
+        self.logger.debug('Getting items for node %s between %s and %s',
+            node, since, until)
+        conditions = [Item.node == node]
+        if since is not None:
+            conditions.append(Item.updated > since)
+        if until is not None:
+            conditions.append(Item.updated <= until)
+        if after is not None:
+            updated, item_id = after
+            conditions.append(Or(Item.updated < updated,
+                And(Item.updated == updated, Item.id > item_id)))
+        if ids is not None:
+            conditions.append(Item.id.is_in(ids))
+        items = self._reader().find(Item, *conditions).order_by(
+            Desc(Item.updated), Item.id)
+        if limit is not None:
+            items = items[:limit]
+        items = list(items)
+        self.end_reads()
+        return items
+
+    def add_records(self, records):
+        """Add a chunk of exported records in a single transaction."""
+        self.logger.debug('Adding %d records', len(records))
+        changed = set()
+        for record in records:
+            typ = record[u'type']
+            if typ != u'item':
+                changed.add(record[u'node'])
+            if typ == u'node':
+                obj = Node(record[u'node'])
+            elif typ == u'config':
+                obj = NodeConfig(record[u'node'], record[u'key'],
+                    record[u'value'])
+                obj.updated = record[u'updated']
+            elif typ == u'affiliation':
+                obj = Affiliation(record[u'node'], record[u'user'],
+                    record[u'affiliation'], record[u'updated'])
+            elif typ == u'subscription':
+                obj = Subscription(record[u'node'], record[u'user'],
+                    record[u'listener'], record[u'subscription'],
+                    record[u'updated'])
+            elif typ == u'item':
+                obj = Item(record[u'node'], record[u'id'], record[u'updated'],
+                    record[u'xml'])
+            else:
+                raise ValueError('Unknown record type %r' % typ)
+            self.store.add(obj)
+        self.store.commit()
+        for node in changed:
+            self.node_changed(node)
+
     def shutdown(self):
         """Shut down this storage module - flush, commit and close the
         store."""
         self.store.flush()
         self.store.commit()
         self.store.close()
+        if self.reader is not self.store:
+            self.reader.close()
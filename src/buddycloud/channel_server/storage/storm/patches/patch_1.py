@@ -0,0 +1,15 @@
+# Copyright 2012 James Tait - All Rights Reserved
+
+"""Index subscriptions by user and items by node and date, for the inbox."""
+
+
+def apply(store):
+    """Add the subscriptions_user and items_node_updated indexes."""
+    store.execute(
+        """
+        CREATE INDEX subscriptions_user ON subscriptions ("user");
+        """)
+    store.execute(
+        """
+        CREATE INDEX items_node_updated ON items (node, updated);
+        """)
@@ -29,6 +29,9 @@ CREATE = [
     CREATE INDEX items_updated ON items (updated);
     """,
     """
+    CREATE INDEX items_node_updated ON items (node, updated);
+    """,
+    """
     CREATE TABLE subscriptions (node TEXT REFERENCES nodes (node),
                                 "user" TEXT,
                                 listener TEXT,
@@ -40,6 +43,9 @@ CREATE = [
     CREATE INDEX subscriptions_updated ON subscriptions (updated);
     """,
     """
+    CREATE INDEX subscriptions_user ON subscriptions ("user");
+    """,
+    """
     CREATE TABLE affiliations (node TEXT REFERENCES nodes (node),
                                "user" TEXT,
                                affiliation TEXT,
@@ -77,4 +83,10 @@ DELETE = [
     """,
 ]
 
+# The table Storm records applied patches in, for taking on a database whose
+# tables were made by hand.
+CREATE_PATCH = """
+    CREATE TABLE patch (version INTEGER NOT NULL PRIMARY KEY)
+    """
+
 schema = Schema(CREATE, DROP, DELETE, patches)
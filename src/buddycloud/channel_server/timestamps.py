@@ -0,0 +1,24 @@
+# Copyright 2012 James Tait - All Rights Reserved
+
+"""Timestamp handling for buddycloud channel server."""
+
+from datetime import datetime
+
+
+TIMESTAMP_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S')
+
+
+def parse_timestamp(value):
+    """Parse an XEP-0082 or isoformat() timestamp into a naive UTC datetime.
+
+    Only UTC timestamps are understood, which is what clients send and what
+    the server stores."""
+    value = value.strip()
+    if value.endswith('Z'):
+        value = value[:-1]
+    for timestamp_format in TIMESTAMP_FORMATS:
+        try:
+            return datetime.strptime(value, timestamp_format)
+        except ValueError:
+            pass
+    raise ValueError('Unrecognised timestamp %r' % value)
@@ -0,0 +1,52 @@
+# Copyright 2012 James Tait - All Rights Reserved
+
+"""Sampled stanza tracing for buddycloud channel server."""
+
+import collections
+import functools
+import time
+
+from xmpp.simplexml import ustr
+
+
+class StanzaTracer(object):
+    """Records a sample of incoming stanzas, and how long their handlers
+    took, in a fixed-size ring buffer.
+
+    Handlers are wrapped when they are registered.  When tracing is off the
+    handler is returned unwrapped, so it costs nothing at all; when it is on,
+    only one stanza in every `sample_every` is serialised.
+    """
+
+    def __init__(self, enabled=False, sample_every=100, size=1000):
+        self.enabled = enabled
+        self.sample_every = max(1, sample_every)
+        self.records = collections.deque(maxlen=size)
+        self.count = 0
+
+    def wrap(self, handler):
+        """Wrap a stanza handler so that its stanzas are sampled."""
+        if not self.enabled:
+            return handler
+
+        @functools.wraps(handler)
+        def traced(conn, stanza, *args):
+            self.count += 1
+            if self.count % self.sample_every:
+                return handler(conn, stanza, *args)
+            # Serialise up front as handlers may modify the stanza.
+            xml = ustr(stanza)
+            started = time.time()
+            try:
+                return handler(conn, stanza, *args)
+            finally:
+                self.records.append(
+                    (started, time.time() - started, handler.__name__, xml))
+        return traced
+
+    def dump(self):
+        """Get the recorded stanzas, oldest first, as lines of text."""
+        return [u'%s %.3fms %s %s' % (
+            time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(started)),
+            elapsed * 1000, name, xml)
+            for started, elapsed, name, xml in list(self.records)]
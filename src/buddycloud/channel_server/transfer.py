@@ -0,0 +1,212 @@
+#! /usr/bin/env python
+
+# Copyright 2012 James Tait - All Rights Reserved
+
+"""Export and import of channel data for buddycloud channel server.
+
+Channels are streamed as JSON-lines records, one per node, config entry,
+affiliation, subscription and item.  Each node's records are followed by a
+checkpoint record, so an interrupted export can be resumed after the last
+node that was written out in full.  Everything is done through generators,
+and items are read a page at a time, so that memory use does not depend on
+the size of the deployment.
+
+The back-end needs get_nodes and get_node to return node objects, as the
+Storm back-end does, and must implement get_items and add_records.  The
+in-memory back-end does not, so it cannot be exported or imported.
+"""
+
+import ConfigParser
+import json
+import logging
+import os
+
+from optparse import OptionParser
+
+from buddycloud.channel_server.storage import init_storage
+from buddycloud.channel_server.timestamps import parse_timestamp
+
+
+# The number of items read from storage at a time.
+ITEM_PAGE_SIZE = 500
+
+
+def _timestamp(value):
+    """Convert a datetime to its exported form."""
+    return value.isoformat() if value is not None else None
+
+
+def _parse_timestamp(value):
+    """Convert an exported timestamp back to a datetime."""
+    return parse_timestamp(value) if value is not None else None
+
+
+def _iter_items(storage, node):
+    """Generate every item of a node, a page at a time."""
+    after = None
+    while True:
+        page = list(storage.get_items(node, limit=ITEM_PAGE_SIZE, after=after))
+        for item in page:
+            yield item
+        if len(page) < ITEM_PAGE_SIZE:
+            break
+        after = (page[-1].updated, page[-1].id)
+
+
+def export_records(storage, after=None):
+    """Generate the records for every node in the storage back-end.
+
+    Nodes are exported in name order.  If `after` is given, every node up to
+    and including it is skipped, which is how an export is resumed.
+    """
+    for name in sorted(channel.node for channel in storage.get_nodes()):
+        if after is not None and name <= after:
+            continue
+        channel = storage.get_node(name)
+        yield {u'type': u'node', u'node': name}
+        for c in channel.config:
+            yield {u'type': u'config', u'node': name, u'key': c.key,
+                u'value': c.value, u'updated': _timestamp(c.updated)}
+        for a in channel.affiliations:
+            yield {u'type': u'affiliation', u'node': name, u'user': a.user,
+                u'affiliation': a.affiliation,
+                u'updated': _timestamp(a.updated)}
+        for s in channel.subscriptions:
+            yield {u'type': u'subscription', u'node': name, u'user': s.user,
+                u'listener': s.listener, u'subscription': s.subscription,
+                u'updated': _timestamp(s.updated)}
+        for i in _iter_items(storage, name):
+            yield {u'type': u'item', u'node': name, u'id': i.id,
+                u'updated': _timestamp(i.updated), u'xml': i.xml}
+        yield {u'type': u'checkpoint', u'node': name}
+
+
+def encode_records(records):
+    """Serialise records to JSON lines."""
+    for record in records:
+        yield json.dumps(record) + '\n'
+
+
+def decode_records(lines):
+    """Parse JSON lines back into records, restoring timestamps."""
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        record = json.loads(line)
+        if u'updated' in record:
+            record[u'updated'] = _parse_timestamp(record[u'updated'])
+        yield record
+
+
+def chunked(records, chunk_size):
+    """Group the records into lists of at most `chunk_size`, dropping
+    checkpoints."""
+    chunk = []
+    for record in records:
+        if record[u'type'] == u'checkpoint':
+            continue
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def find_checkpoint(export_file):
+    """Find the last checkpoint in a partial export.
+
+    Returns a tuple of the last fully-exported node (or None) and the offset
+    just past its checkpoint record, where the export should carry on.
+    """
+    node, offset = None, 0
+    export_file.seek(0)
+    while True:
+        line = export_file.readline()
+        if not line.endswith('\n'):
+            break
+        try:
+            record = json.loads(line)
+        except ValueError:
+            break
+        if record.get(u'type') == u'checkpoint':
+            node, offset = record[u'node'], export_file.tell()
+    return node, offset
+
+
+def export_storage(storage, filename, resume=False):
+    """Export the whole storage back-end to a file, returning the number of
+    records written."""
+    after = None
+    if resume and os.path.isfile(filename):
+        export_file = open(filename, 'r+')
+        after, offset = find_checkpoint(export_file)
+        export_file.seek(offset)
+        export_file.truncate()
+    else:
+        export_file = open(filename, 'w')
+    count = 0
+    try:
+        for line in encode_records(export_records(storage, after)):
+            export_file.write(line)
+            count += 1
+    finally:
+        export_file.close()
+    return count
+
+
+def import_storage(storage, filename, chunk_size=500):
+    """Import an export file into the storage back-end, returning the number
+    of records read."""
+    count = 0
+    import_file = open(filename, 'r')
+    try:
+        for chunk in chunked(decode_records(import_file), chunk_size):
+            storage.add_records(chunk)
+            count += len(chunk)
+    finally:
+        import_file.close()
+    return count
+
+
+if __name__ == '__main__':
+    parser = OptionParser('%prog [options] export|import FILE')
+    parser.add_option('--config', dest='config_file',
+            default='conf/channel_server.conf',
+            help='The configuration file to use.')
+    parser.add_option('--resume', dest='resume', action='store_true',
+            default=False,
+            help='Carry on an interrupted export from its last checkpoint.')
+    parser.add_option('--chunk-size', dest='chunk_size', type='int',
+            default=500,
+            help='The number of records to insert per transaction on import.')
+    options, args = parser.parse_args()
+
+    if len(args) != 2 or args[0] not in ('export', 'import'):
+        parser.error('Expected export or import and a file name.')
+    if not os.path.isfile(options.config_file):
+        parser.error('Specified config file %s does not exist!' %
+                options.config_file)
+    config = ConfigParser.ConfigParser()
+    config.read(options.config_file)
+
+    logger = logging.getLogger('transfer')
+    handler = logging.StreamHandler()
+    formatter = logging.Formatter(
+        config.get('Logging', 'log_format', raw=True))
+    handler.setFormatter(formatter)
+    logger.setLevel(logging.__getattribute__(
+        config.get('Logging', 'log_level')))
+    logger.addHandler(handler)
+
+    storage = init_storage(config)
+    command, filename = args
+    try:
+        if command == 'export':
+            count = export_storage(storage, filename, options.resume)
+        else:
+            count = import_storage(storage, filename, options.chunk_size)
+    finally:
+        storage.shutdown()
+    logger.info('%s of %s complete: %d records', command, filename, count)